@@ -24,31 +24,120 @@ Usage examples:
    $ python3 create_snapshot.py --kubeconfig /tmp/kubeconfig
  * Specifying timeout for the kubectl calls (default is 15 seconds):
    $ python3 create_snapshot.py --timeout 10
+ * Logging every executed kubectl command:
+   $ python3 create_snapshot.py -v
+ * Limiting the number of kubectl commands running concurrently:
+   $ python3 create_snapshot.py --parallelism 4
+ * Collecting up to 50000 lines of logs of the last 2 days per container
+   (defaults are 10000 lines, 10 MiB and 24h, --log-since 0 for all logs):
+   $ python3 create_snapshot.py --max-log-lines 50000 --log-since 48h
 
 Output:
 snapshot-{timestamp}.tar.gz file containing outputs of various kubectl commands
 that were executed. The file is created in the current working directory.
 
+Security:
+The kubectl commands go through a `kubectl proxy` listening on 127.0.0.1 while
+the snapshot is created. Any local user or process can send requests to it,
+and they are made with the credentials of the kubeconfig used. The proxy only
+accepts read requests (no POST, PUT, PATCH or DELETE), but those can still
+read everything the credentials allow, so run the script on a trusted host.
+
 Requirements:
  * Python 3.8 (but probably work with lower versions of Python 3 too)
  * kubectl available through $PATH
+ * Optionally pigz available through $PATH, for faster compression
 
 """
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import fractions
+import functools
+import gzip
+import http.client
+import io
+import itertools
+import logging
 import os
 import pathlib
+import re
+import select
+import shlex
+import shutil
 import subprocess
+import sys
 import tarfile
 import tempfile
+import threading
 import time
+import urllib.parse
 
 CMD_TIMEOUT_SEC = 15
-BACKOFF_LIMIT = 4
+# kubectl already backs off on throttling by itself, only give transient
+# network errors a second chance instead of stalling every failing command.
+RETRIES = 1
+RETRIABLE_ERRORS = ('i/o timeout', 'connection refused', 'Too Many Requests')
+# Grace period after --request-timeout before a kubectl process is killed.
+SUBPROCESS_TIMEOUT_GRACE_SEC = 2
+# Bound the runtime and size of every log job, a single noisy container
+# shouldn't dominate the snapshot.
+MAX_LOG_LINES = 10000
+MAX_LOG_BYTES = 10 * 1024 * 1024
+LOG_SINCE = '24h'
+# Go duration syntax accepted by `kubectl logs --since`, in seconds per unit.
+DURATION_PART_RE = r'(\d+\.?\d*|\.\d+)(ns|us|\u00b5s|\u03bcs|ms|s|m|h)'
+DURATION_UNITS = {
+    'ns': fractions.Fraction(1, 10**9),
+    'us': fractions.Fraction(1, 10**6),
+    '\u00b5s': fractions.Fraction(1, 10**6),
+    '\u03bcs': fractions.Fraction(1, 10**6),
+    'ms': fractions.Fraction(1, 10**3),
+    's': 1,
+    'm': 60,
+    'h': 3600,
+}
+# kubectl calls are I/O bound, so oversubscribe the CPUs, but keep the pool
+# bounded to not flood the apiserver (and the host) with kubectl processes.
+DEFAULT_PARALLELISM = min(32, (os.cpu_count() or 1) * 4)
+PROXY_START_TIMEOUT_SEC = 10
+# The proxy is reachable by every local user while the snapshot runs, and the
+# snapshot only reads from the cluster, so refuse anything that could modify
+# it with the operator's credentials.
+PROXY_REJECT_METHODS = '^(POST|PUT|PATCH|DELETE)$'
+HEALTH_CHECK_TIMEOUT_SEC = 5
+# yaml and logs compress almost as well at level 1 as at the default level,
+# for a fraction of the CPU time.
+COMPRESS_LEVEL = 1
 
-KUBECTL_GLOBAL_CMDS = [
+# Kubeconfig used by the kubectl commands going through `kubectl proxy`. The
+# proxy takes care of the authentication, so no user credentials are needed.
+PROXY_KUBECONFIG = '''apiVersion: v1
+kind: Config
+clusters:
+- name: proxy
+  cluster:
+    server: {server}
+contexts:
+- name: proxy
+  context:
+    cluster: proxy
+current-context: proxy
+'''
+
+# These commands report on the connection to the cluster itself, so they are
+# always executed with the original kubeconfig and never through the proxy.
+KUBECTL_DIRECT_CMDS = [
     'kubectl version {kubeconfig_arg} --request-timeout {timeout}',
     'kubectl cluster-info {kubeconfig_arg} --request-timeout {timeout}',
+]
+
+# `kubectl describe` is not collected: it re-fetches every object (plus its
+# events) from the apiserver just to pretty-print what the yaml dumps below
+# already contain. Events are gathered once per namespace instead.
+KUBECTL_GLOBAL_CMDS = [
     'kubectl get clusterroles -o wide {kubeconfig_arg} --request-timeout {timeout}',          # noqa: E501
     'kubectl get clusterrolebindings -o wide {kubeconfig_arg} --request-timeout {timeout}',   # noqa: E501
     'kubectl get crd -o wide {kubeconfig_arg} --request-timeout {timeout}',
@@ -57,22 +146,90 @@ KUBECTL_GLOBAL_CMDS = [
     'kubectl get clusterrolebindings -o yaml {kubeconfig_arg} --request-timeout {timeout}',   # noqa: E501
     'kubectl get crd -o yaml {kubeconfig_arg} --request-timeout {timeout}',
     'kubectl get nodes -o yaml {kubeconfig_arg} --request-timeout {timeout}',
-    'kubectl describe clusterroles {kubeconfig_arg} --request-timeout {timeout}',             # noqa: E501
-    'kubectl describe clusterrolebindings {kubeconfig_arg} --request-timeout {timeout}',      # noqa: E501
-    'kubectl describe crd {kubeconfig_arg} --request-timeout {timeout}',
-    'kubectl describe nodes {kubeconfig_arg} --request-timeout {timeout}',
 ]
 
 KUBECTL_PER_NS_CMDS = [
     'kubectl get all -o wide {kubeconfig_arg} --request-timeout {timeout} --namespace {namespace}',  # noqa: E501
     'kubectl get all -o yaml {kubeconfig_arg} --request-timeout {timeout} --namespace {namespace}',  # noqa: E501
-    'kubectl describe all {kubeconfig_arg} --request-timeout {timeout} --namespace {namespace}',     # noqa: E501
+    'kubectl get events -o wide {kubeconfig_arg} --request-timeout {timeout} --namespace {namespace}',  # noqa: E501
 ]
 
 KUBECTL_PER_POD_CMDS = [
-    'kubectl logs {kubeconfig_arg} {pod} --container {container} --request-timeout {timeout} --namespace {namespace}',  # noqa: E501
+    'kubectl logs {kubeconfig_arg} {pod} --container {container} --tail {max_log_lines} --limit-bytes {max_log_bytes} --since {log_since} --timestamps --request-timeout {timeout} --namespace {namespace}',  # noqa: E501
 ]
 
+# One "<namespace>\t<pod>\t<container>,<container>,...\n" line per pod.
+POD_CONTAINERS_JSONPATH = \
+    r'{range .items[*]}{.metadata.namespace}{"\t"}{.metadata.name}{"\t"}' \
+    r'{range .spec.containers[*]}{.name}{","}{end}{"\n"}{end}'
+
+# Jobs with a url are read straight from the kubectl proxy instead of running
+# argv, which is only used to name the output then.
+Job = collections.namedtuple('Job', ['argv', 'subfolder', 'name', 'url'],
+                             defaults=[None])
+
+# Keep-alive connections to the kubectl proxy, one per worker thread.
+proxy_connections = threading.local()
+
+
+def compile_cmd(template):
+    """Parses a command template once into a function building its argv.
+
+    The returned function takes the list of kubeconfig arguments plus the
+    template fields and returns an (argv, name) tuple, no shell involved. Every
+    placeholder is formatted into a single argument, so namespace or pod names
+    can never be interpreted by a shell. `{kubeconfig_arg}` expands to the
+    (possibly empty) list of kubeconfig arguments and is left out of the name,
+    which is used as the output file name.
+    """
+    tokens = template.split()
+    kubeconfig_index = None
+    if '{kubeconfig_arg}' in tokens:
+        kubeconfig_index = tokens.index('{kubeconfig_arg}')
+        del tokens[kubeconfig_index]
+    # All arguments are formatted by a single str.format call and split again
+    # on NUL, which can't be part of any process argument.
+    joined_template = '\0'.join(tokens)
+
+    def expand(kubeconfig_args, **kwargs):
+        args = joined_template.format(**kwargs).split('\0')
+        if kubeconfig_index is None:
+            return args, '_'.join(args)
+        name = '_'.join(args[:kubeconfig_index] + [''] +
+                        args[kubeconfig_index:])
+        args[kubeconfig_index:kubeconfig_index] = kubeconfig_args
+        return args, name
+    return expand
+
+
+# Templates are split at import time, expanding them for every namespace, pod
+# and container then takes a single str.format call.
+KUBECTL_DIRECT_CMDS = [compile_cmd(cmd) for cmd in KUBECTL_DIRECT_CMDS]
+KUBECTL_GLOBAL_CMDS = [compile_cmd(cmd) for cmd in KUBECTL_GLOBAL_CMDS]
+KUBECTL_PER_NS_CMDS = [compile_cmd(cmd) for cmd in KUBECTL_PER_NS_CMDS]
+KUBECTL_PER_POD_CMDS = [compile_cmd(cmd) for cmd in KUBECTL_PER_POD_CMDS]
+
+
+def duration_seconds(duration):
+    """Converts a Go duration such as '24h', '1h30m' or '1.5h' to seconds.
+
+    Like `kubectl logs --since`, the result is rounded to the nearest second.
+    """
+    if duration == '0':
+        return 0
+    if not re.fullmatch('(?:{})+'.format(DURATION_PART_RE), duration):
+        raise argparse.ArgumentTypeError(
+            'invalid duration {!r}, expected e.g. 24h, 1h30m or 1.5h'.format(
+                duration))
+    total = sum(fractions.Fraction(number) * DURATION_UNITS[unit]
+                for number, unit in re.findall(DURATION_PART_RE, duration))
+    seconds = int(total + fractions.Fraction(1, 2))
+    if total and not seconds:
+        raise argparse.ArgumentTypeError(
+            'duration {!r} is shorter than a second, use 0 for all '
+            'logs'.format(duration))
+    return seconds
+
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -87,119 +244,465 @@ def parse_args():
     parser.add_argument('--timeout', dest='timeout', action='store',
                         default=CMD_TIMEOUT_SEC, type=int,
                         help='Timeout for kubectl commands.')
+    parser.add_argument('--parallelism', dest='parallelism', action='store',
+                        default=DEFAULT_PARALLELISM, type=int,
+                        help='Maximum number of kubectl commands executed '
+                        'concurrently.')
+    parser.add_argument('--max-log-lines', dest='max_log_lines',
+                        action='store', default=MAX_LOG_LINES, type=int,
+                        help='Maximum number of most recent log lines '
+                        'collected per container.')
+    parser.add_argument('--max-log-bytes', dest='max_log_bytes',
+                        action='store', default=MAX_LOG_BYTES, type=int,
+                        help='Maximum number of log bytes collected per '
+                        'container.')
+    parser.add_argument('--log-since', dest='log_since', action='store',
+                        default=LOG_SINCE,
+                        help='Only collect logs newer than this duration, '
+                        'in kubectl --since (Go duration) syntax, e.g. 24h, '
+                        '1h30m or 1.5h. 0 collects all logs.')
+    parser.add_argument('-v', '--verbose', dest='verbose',
+                        action='store_true',
+                        help='Log every executed command.')
     args = parser.parse_args()
-    return args.kubeconfig, args.timeout
-
-
-def run_cmd(cmd: str, subfolder: str, output_dir: pathlib.Path):  # noqa: E999
-    output_path = output_dir / subfolder / cmd.replace(' ', '_')
-    output_path.parent.mkdir(parents=True, exist_ok=True)
-    print("Executing: {}... ".format(cmd), end='')
-    backoff_timer = 1
-    backoff_count = 0
-    with open(output_path, mode='w') as output_file:
-        while True:
-            if backoff_count > BACKOFF_LIMIT:
-                print('[ FAIL ]')
-                return
-            process = subprocess.run(cmd, stdout=output_file,
-                                     stderr=output_file,
-                                     timeout=60,
-                                     shell=True)
-            if not process.returncode:
-                print("[ DONE ]")
-                return
-            print("\nCommand failed, trying again in {}s. ' \
-                  'Error output: {}".format(backoff_timer, process.stderr))
-            time.sleep(backoff_timer)
-            backoff_timer *= 2
-            backoff_count += 1
-
-
-def get_kubectl_list(object_type, kubeconfig, timeout, namespace=None,
-                     object_name='', jsonpath="{.items[*].metadata.name}"):
-    cmd = 'kubectl get {obj_type} {kubeconfig_arg} ' \
-          '--request-timeout {timeout} ' \
-          '-o jsonpath="{jsonpath}" {obj_name}'. \
-          format(kubeconfig_arg=kubeconfig,
-                 jsonpath=jsonpath,
-                 timeout=timeout,
-                 obj_type=object_type, obj_name=object_name)
-    if namespace:
-        cmd = "{} -n {}".format(cmd, namespace)
-    backoff_timer = 1
-    backoff_count = 0
-    print("Executing: {}... ".format(cmd), end='')
-    while True:
-        if backoff_count > BACKOFF_LIMIT:
-            print('[ FAIL ]')
-            return
-        process = subprocess.run(cmd, shell=True,
-                                 capture_output=True)
+    if args.parallelism < 1:
+        parser.error('--parallelism must be at least 1')
+    if args.max_log_lines < 1 or args.max_log_bytes < 1:
+        parser.error('--max-log-lines and --max-log-bytes must be at least 1')
+    try:
+        duration_seconds(args.log_since)
+    except argparse.ArgumentTypeError as error:
+        parser.error('--log-since: {}'.format(error))
+    return args.kubeconfig, args.timeout, args.parallelism, \
+        (args.max_log_lines, args.max_log_bytes, args.log_since), args.verbose
+
+
+@contextlib.contextmanager
+def open_snapshot(path: pathlib.Path):
+    """Opens the snapshot archive as a streamed tar.gz file for writing.
+
+    Compression runs in a pigz process on all cores when pigz is available,
+    and falls back to single-threaded gzip in this process otherwise. Raises
+    RuntimeError when pigz fails, the archive is incomplete then.
+    """
+    with open(path, 'wb') as snap_out:
+        pigz = shutil.which('pigz')
+        if pigz:
+            compressor = subprocess.Popen(
+                [pigz, '-{}'.format(COMPRESS_LEVEL)],
+                stdin=subprocess.PIPE, stdout=snap_out)
+            compressed = compressor.stdin
+        else:
+            compressor = None
+            compressed = gzip.GzipFile(fileobj=snap_out, mode='wb',
+                                       compresslevel=COMPRESS_LEVEL)
+        try:
+            try:
+                with tarfile.open(fileobj=compressed, mode='w|') as snap_file:
+                    yield snap_file
+            finally:
+                try:
+                    compressed.close()
+                finally:
+                    if compressor:
+                        compressor.wait()
+        except BrokenPipeError as error:
+            raise RuntimeError(compressor_error(pigz, compressor, path)) \
+                from error
+        if compressor and compressor.returncode:
+            raise RuntimeError(compressor_error(pigz, compressor, path))
+
+
+def compressor_error(pigz: str, compressor: subprocess.Popen,
+                     path: pathlib.Path) -> str:
+    return '{} exited with code {} while writing {}'.format(
+        pigz, compressor.returncode, path)
+
+
+def add_to_snapshot(snap_file: tarfile.TarFile, snap_lock: threading.Lock,
+                    name: str, data: bytes):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = time.time()
+    # The streamed archive is append-only, members are written one at a time.
+    with snap_lock:
+        snap_file.addfile(info, io.BytesIO(data))
+
+
+def run_kubectl(argv, timeout: int):
+    """Runs a kubectl command, retrying it only on transient errors.
+
+    The process is killed shortly after its own --request-timeout expired.
+    Returns the subprocess.CompletedProcess of the last attempt.
+    """
+    cmd = shlex.join(argv)
+    logging.debug('Executing: %s', cmd)
+    sub_timeout = timeout + SUBPROCESS_TIMEOUT_GRACE_SEC
+    for attempt in range(RETRIES + 1):
+        try:
+            process = subprocess.run(argv, capture_output=True,
+                                     timeout=sub_timeout)
+        except subprocess.TimeoutExpired as error:
+            process = subprocess.CompletedProcess(
+                argv, 1, error.stdout or b'',
+                'Command timed out after {}s\n'.format(sub_timeout).encode())
         if not process.returncode:
-            print("[ DONE ]")
-            obj_list = process.stdout.decode().strip().split(' ')
-            if '' in obj_list:
-                obj_list.remove('')
-            return obj_list
-        print("\nCommand failed, trying again in {}s. ' \
-              'Error output: {}".format(backoff_timer, process.stderr))
-        time.sleep(backoff_timer)
-        backoff_timer *= 2
-        backoff_count += 1
+            logging.debug('[ DONE ] %s', cmd)
+            return process
+        error_output = process.stderr.decode(errors='replace')
+        if attempt < RETRIES and \
+                any(pattern in error_output for pattern in RETRIABLE_ERRORS):
+            logging.warning('Command failed, trying again: %s. '
+                            'Error output: %s', cmd, error_output.strip())
+            continue
+        logging.warning('[ FAIL ] %s. Error output: %s', cmd,
+                        error_output.strip())
+        return process
 
 
-def main():
-    kubeconfig, timeout = parse_args()
-    timeout = "{}s".format(timeout)
-    if kubeconfig:
-        kubeconfig = \
-          '--kubeconfig {}'.format(pathlib.Path(kubeconfig).absolute())
+def read_proxy_url(url, timeout: int):
+    """GETs an url of the kubectl proxy, mimicking run_kubectl.
+
+    Reuses the keep-alive connection of the calling thread, so reading many
+    urls costs neither a kubectl process nor a new connection each.
+    Returns a subprocess.CompletedProcess with the response body as stdout.
+    """
+    url = urllib.parse.urlsplit(url)
+    path = '{}?{}'.format(url.path, url.query)
+    logging.debug('Fetching: %s', path)
+    if getattr(proxy_connections, 'netloc', None) != url.netloc:
+        proxy_connections.netloc = url.netloc
+        proxy_connections.connection = http.client.HTTPConnection(
+            url.netloc, timeout=timeout + SUBPROCESS_TIMEOUT_GRACE_SEC)
+    connection = proxy_connections.connection
+    for attempt in range(RETRIES + 1):
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            body = response.read()
+        except (http.client.HTTPException, OSError) as error:
+            # Also covers the proxy closing an idle keep-alive connection.
+            connection.close()
+            if attempt < RETRIES:
+                continue
+            logging.warning('[ FAIL ] %s. Error: %s', path, error)
+            return subprocess.CompletedProcess(path, 1, b'',
+                                               str(error).encode())
+        if response.status == http.client.OK:
+            logging.debug('[ DONE ] %s', path)
+            return subprocess.CompletedProcess(path, 0, body, b'')
+        logging.warning('[ FAIL ] %s. Error output: %s', path,
+                        body.decode(errors='replace').strip())
+        return subprocess.CompletedProcess(path, 1, b'', body)
+
+
+def run_cmd(job: Job, timeout: int, snapshot_name: str,  # noqa: E999
+            snap_file: tarfile.TarFile, snap_lock: threading.Lock):
+    """Runs a single job, adds its output to the snapshot archive and returns
+    a (member_name, succeeded) tuple."""
+    member_name = '{}/{}/{}'.format(snapshot_name, job.subfolder, job.name)
+    if job.url:
+        process = read_proxy_url(job.url, timeout)
+    else:
+        process = run_kubectl(job.argv, timeout)
+    # stdout is archived as is, so that e.g. deprecation warnings printed by
+    # kubectl don't end up in the middle of a yaml dump. Failed commands keep
+    # their error output.
+    output = process.stdout
+    if process.returncode:
+        output += process.stderr
+    add_to_snapshot(snap_file, snap_lock, member_name, output)
+    return member_name, not process.returncode
+
+
+def run_query(argv, timeout: int):
+    """Runs a kubectl query and returns its decoded output.
+
+    Raises RuntimeError if the query fails.
+    """
+    process = run_kubectl(argv, timeout)
+    if process.returncode:
+        raise RuntimeError('{} failed: {}'.format(
+            shlex.join(argv), process.stderr.decode(errors='replace').strip()))
+    return process.stdout.decode()
 
-    namespaces_list = get_kubectl_list('namespaces', kubeconfig, timeout)
 
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        output_dir = pathlib.PosixPath(tmp_dir)
-        for cmd in KUBECTL_GLOBAL_CMDS:
-            run_cmd(
-                cmd.format(kubeconfig_arg=kubeconfig, timeout=timeout),
-                'global', output_dir
-            )
+@functools.lru_cache(maxsize=None)
+def get_kubectl_list(object_type, kubeconfig, timeout):
+    """Returns the names of the listed cluster scoped objects as a tuple.
+
+    Results are memoized per kubeconfig, so it has to be a tuple of arguments.
+    Going through the proxy, that is a different kubeconfig for every run.
+    """
+    argv = ['kubectl', 'get', object_type, *kubeconfig,
+            '--request-timeout', '{}s'.format(timeout),
+            '-o', 'jsonpath={.items[*].metadata.name}']
+    return tuple(run_query(argv, timeout).split())
+
+
+def fetch_all_pod_containers(kubeconfig, timeout):
+    """Returns the containers of all pods as {(namespace, pod): [containers]}.
+
+    Uses a single list call for the whole cluster instead of one query per
+    namespace and per pod.
+    """
+    argv = ['kubectl', 'get', 'pods', '--all-namespaces', *kubeconfig,
+            '--request-timeout', '{}s'.format(timeout),
+            '-o', 'jsonpath={}'.format(POD_CONTAINERS_JSONPATH)]
+    output = run_query(argv, timeout)
+    pod_index = {}
+    for line in output.splitlines():
+        if not line:
+            continue
+        namespace, pod, containers = line.split('\t')
+        pod_index[(namespace, pod)] = \
+            [c for c in containers.rstrip(',').split(',') if c]
+    return pod_index
+
+
+def check_cluster_reachable(kubeconfig, timeout: int):
+    """Exits early if kubectl can't be run or the apiserver can't be reached.
+
+    Otherwise every single command of the snapshot would wait for its own
+    timeout (and retry) before failing.
+    """
+    argv = ['kubectl', 'version', *kubeconfig,
+            '--request-timeout', '{}s'.format(HEALTH_CHECK_TIMEOUT_SEC)]
+    # The request itself should be quick, but the process also runs the auth
+    # plugin of the kubeconfig, give it as long as any other command.
+    sub_timeout = max(HEALTH_CHECK_TIMEOUT_SEC, timeout) + \
+        SUBPROCESS_TIMEOUT_GRACE_SEC
+    try:
+        process = subprocess.run(argv, capture_output=True,
+                                 timeout=sub_timeout)
+    except subprocess.TimeoutExpired:
+        error_output = 'timed out after {}s'.format(sub_timeout)
+    except OSError as error:
+        error_output = str(error)
+    else:
+        if not process.returncode:
+            return
+        error_output = process.stderr.decode(errors='replace').strip()
+    logging.error('Cannot reach the cluster, no snapshot created. '
+                  '%s: %s', shlex.join(argv), error_output)
+    sys.exit(2)
+
+
+@contextlib.contextmanager
+def kubectl_proxy(kubeconfig):
+    """Starts `kubectl proxy` and yields a (kubeconfig_args, address) tuple.
+
+    Every kubectl process otherwise loads the kubeconfig, runs the auth plugin
+    and does a TLS handshake with the apiserver on its own. Going through a
+    single long-lived proxy pays for that only once per snapshot. Falls back to
+    the original kubeconfig arguments and a None address if the proxy cannot be
+    started.
+    """
+    proxy = subprocess.Popen(['kubectl', 'proxy', '--port=0',
+                              '--reject-methods={}'.format(
+                                  PROXY_REJECT_METHODS),
+                              *kubeconfig],
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL)
+    try:
+        ready, _, _ = select.select([proxy.stdout], [], [],
+                                    PROXY_START_TIMEOUT_SEC)
+        line = proxy.stdout.readline().decode() if ready else ''
+        match = re.search(r'Starting to serve on (\S+)', line)
+        if not match:
+            logging.warning('Could not start kubectl proxy, connecting to '
+                            'the cluster directly')
+            proxy.terminate()
+            proxy.wait()
+            yield kubeconfig, None
+            return
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            work_dir = pathlib.Path(tmp_dir)
+            config_path = work_dir / 'kubeconfig'
+            config_path.write_text(PROXY_KUBECONFIG.format(
+                server='http://{}'.format(match.group(1))))
+            logging.info('Using kubectl proxy on %s', match.group(1))
+            # The proxy listens on a random port, keep its discovery cache out
+            # of the user's ~/.kube/cache.
+            yield ('--kubeconfig', str(config_path),
+                   '--cache-dir', str(work_dir / 'cache')), match.group(1)
+    finally:
+        proxy.terminate()
+        proxy.wait()
+
+
+class ProgressHandler(logging.StreamHandler):
+    """Logs to stderr, keeping a progress line below the log records.
+
+    The progress line is erased before each record is written and redrawn
+    after it, so log messages of the workers never end up in the middle of it.
+    """
+
+    ERASE_LINE = '\r\033[K'
+
+    def __init__(self, show_progress: bool):
+        super().__init__(sys.stderr)
+        self.show_progress = show_progress
+        self.progress = ''
+
+    def emit(self, record):
+        if self.progress:
+            self.stream.write(self.ERASE_LINE)
+        super().emit(record)
+        if self.progress:
+            self.stream.write(self.progress)
+            self.flush()
+
+    def report_progress(self, done: int, total: int):
+        if not self.show_progress:
+            return
+        with self.lock:
+            self.progress = 'Collected {}/{} outputs'.format(done, total)
+            self.stream.write(self.ERASE_LINE + self.progress)
+            if done == total:
+                self.stream.write('\n')
+                self.progress = ''
+            self.flush()
+
+
+def create_snapshot(kubeconfig, timeout, parallelism, log_limits,
+                    snapshot_name, snapshot_path,
+                    progress: ProgressHandler):
+    """Runs all snapshot commands and writes their outputs to snapshot_path.
+
+    Outputs are streamed into the archive as soon as each command finishes, so
+    compression overlaps with the remaining kubectl work.
+    """
+    max_log_lines, max_log_bytes, log_since = log_limits
+    since_seconds = duration_seconds(log_since)
+    snap_lock = threading.Lock()
+
+    with kubectl_proxy(kubeconfig) as (proxy_kubeconfig, proxy_address), \
+            open_snapshot(snapshot_path) as snap_file, \
+            concurrent.futures.ThreadPoolExecutor(parallelism) as executor:
+
+        request_timeout = '{}s'.format(timeout)
+
+        def make_job(cmd, subfolder, kubeconfig_arg=proxy_kubeconfig,
+                     url=None, **kwargs):
+            argv, name = cmd(kubeconfig_arg, timeout=request_timeout, **kwargs)
+            return Job(argv, subfolder, name, url)
+
+        def pod_log_url(namespace, pod, container):
+            # Same output as the `kubectl logs` command in KUBECTL_PER_POD_CMDS
+            # but read from the proxy, without a kubectl process per container.
+            if not proxy_address:
+                return None
+            query = {
+                'container': container,
+                'tailLines': max_log_lines,
+                'limitBytes': max_log_bytes,
+                'timestamps': 'true',
+            }
+            # The apiserver rejects sinceSeconds=0, while `kubectl logs
+            # --since 0s` means no limit at all.
+            if since_seconds:
+                query['sinceSeconds'] = since_seconds
+            return 'http://{}/api/v1/namespaces/{}/pods/{}/log?{}'.format(
+                proxy_address,
+                urllib.parse.quote(namespace), urllib.parse.quote(pod),
+                urllib.parse.urlencode(query))
+
+        # Discover namespaces, pods and their containers first, so that every
+        # command can be scheduled upfront and independent calls overlap. The
+        # two discovery queries don't depend on each other either.
+        namespaces_future = executor.submit(
+            get_kubectl_list, 'namespaces', proxy_kubeconfig, timeout)
+        pod_index_future = executor.submit(
+            fetch_all_pod_containers, proxy_kubeconfig, timeout)
+        namespaces_list = namespaces_future.result()
+        pod_index = pod_index_future.result()
+
+        jobs = [make_job(cmd, 'global', kubeconfig_arg=kubeconfig)
+                for cmd in KUBECTL_DIRECT_CMDS]
+        jobs += [make_job(cmd, 'global') for cmd in KUBECTL_GLOBAL_CMDS]
         for namespace in namespaces_list:
             for cmd in KUBECTL_PER_NS_CMDS:
-                run_cmd(
-                    cmd.format(
-                      kubeconfig_arg=kubeconfig,
-                      timeout=timeout,
-                      namespace=namespace
-                    ),
+                jobs.append(make_job(
+                    cmd,
                     'namespaces/{}'.format(namespace),
-                    output_dir
-                )
-            for pod in get_kubectl_list('pods',
-                                        kubeconfig, timeout, namespace):
-                containers = get_kubectl_list('pod',
-                                              kubeconfig, timeout,
-                                              namespace=namespace,
-                                              jsonpath="{.spec.containers[*].name}",  # noqa: E501
-                                              object_name=pod)
-                for container in containers:
-                    for cmd in KUBECTL_PER_POD_CMDS:
-                        run_cmd(
-                            cmd.format(kubeconfig_arg=kubeconfig,
-                                       timeout=timeout,
-                                       namespace=namespace,
-                                       pod=pod,
-                                       container=container),
-                            'namespaces/{}/{}'.format(namespace, pod),
-                            output_dir
-                        )
-        # Commands done
-        snapshot_name = 'snapshot-{}'.format(int(time.time()))
-        snap_file = tarfile.open('{}.tar.gz'.format(snapshot_name), 'w:gz')
-        snap_file.add(output_dir, snapshot_name)
-        snap_file.close()
-        print("Created snapshot: {}".format(snap_file.name))
+                    namespace=namespace
+                ))
+        log_jobs_per_ns = collections.defaultdict(list)
+        for (namespace, pod), containers in pod_index.items():
+            for container in containers:
+                for cmd in KUBECTL_PER_POD_CMDS:
+                    log_jobs_per_ns[namespace].append(make_job(
+                        cmd,
+                        'namespaces/{}/{}'.format(namespace, pod),
+                        url=pod_log_url(namespace, pod, container),
+                        namespace=namespace,
+                        pod=pod,
+                        container=container,
+                        max_log_lines=max_log_lines,
+                        max_log_bytes=max_log_bytes,
+                        log_since=log_since
+                    ))
+        # Interleave the log jobs of all namespaces, so that the pool isn't
+        # busy with the pods of a single namespace while the others wait.
+        for log_jobs in itertools.zip_longest(*log_jobs_per_ns.values()):
+            jobs.extend(job for job in log_jobs if job)
+
+        logging.info('Collecting %d outputs', len(jobs))
+        futures = [executor.submit(run_cmd, job, timeout=timeout,
+                                   snapshot_name=snapshot_name,
+                                   snap_file=snap_file, snap_lock=snap_lock)
+                   for job in jobs]
+        failed = 0
+        try:
+            for done, future in enumerate(
+                    concurrent.futures.as_completed(futures), 1):
+                _, succeeded = future.result()
+                failed += not succeeded
+                progress.report_progress(done, len(jobs))
+        except BaseException:
+            # Leaving the executor waits for all submitted jobs, don't start
+            # the queued ones on Ctrl-C or a failing worker.
+            for future in futures:
+                future.cancel()
+            raise
+        if failed:
+            logging.warning('%d out of %d commands failed', failed, len(jobs))
+
+
+def main():
+    kubeconfig, timeout, parallelism, log_limits, verbose = parse_args()
+    # In verbose mode every command is logged, which makes the progress line
+    # redundant.
+    progress = ProgressHandler(show_progress=sys.stderr.isatty() and
+                               not verbose)
+    logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s',
+                        handlers=[progress])
+    if kubeconfig:
+        kubeconfig = \
+          ('--kubeconfig', str(pathlib.Path(kubeconfig).absolute()))
+    else:
+        kubeconfig = ()
+    # Don't serve stale lists when main() runs more than once in a process.
+    get_kubectl_list.cache_clear()
+    check_cluster_reachable(kubeconfig, timeout)
+
+    snapshot_name = 'snapshot-{}'.format(int(time.time()))
+    snapshot_path = pathlib.Path('{}.tar.gz'.format(snapshot_name)).absolute()
+
+    try:
+        try:
+            create_snapshot(kubeconfig, timeout, parallelism, log_limits,
+                            snapshot_name, snapshot_path, progress)
+        except BaseException:
+            # Never leave a truncated archive behind.
+            snapshot_path.unlink(missing_ok=True)
+            raise
+    except RuntimeError as error:
+        logging.error('Could not create snapshot: %s', error)
+        sys.exit(1)
+    logging.info("Created snapshot: %s", snapshot_path)
 
 
 if __name__ == '__main__':